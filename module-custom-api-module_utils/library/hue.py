@@ -1,4 +1,5 @@
 #!/usr/bin/python
+# -*- coding: utf-8 -*-
 
 # (c) 2016, James Cammarata <jimi@sngx.net>
 #
@@ -15,6 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+
 DOCUMENTATION = '''
 ---
 module: hue
@@ -104,105 +107,143 @@ EXAMPLES = '''
     brightness: 128
 '''
 
-STATE_FIELDS = ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect',)
+STATE_FIELDS = frozenset(('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect',))
+
+# module params which are copied as-is to a field of the state
+PARAM_FIELDS = (
+    ('brightness', 'bri'),
+    ('alert', 'alert'),
+    ('effect', 'effect'),
+    ('transition_time', 'transitiontime'),
+)
+
+# every module param which sets part of the state, other than 'on'
+OPTIONAL_PARAMS = ('brightness', 'alert', 'effect', 'transition_time', 'hue', 'saturation', 'xy', 'rgb', 'color_temp',)
+
+# The Wide Gamut RGB to XYZ conversion matrix, from the colorspace values here:
+# http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
+RGB2XYZ = (
+    (0.7161046, 0.1009296, 0.1471858),
+    (0.2581874, 0.7249378, 0.0168748),
+    (0.0000000, 0.0517813, 0.7734287),
+)
 
 def hex2rgb(hex):
     '''
-    Converts a hex string to an RGB value.
+    Converts a hex string to an RGB value. The string is expected to have
+    already been validated by rgb_type().
     '''
-    hex = hex.lstrip('#')
-    assert len(hex) == 6
-    return (int(hex[0:2], 16), int(hex[2:4], 16), int(hex[4:6], 16))
+    return tuple(bytearray.fromhex(hex.lstrip('#')))
 
 def rgb2xy(r, g, b):
     '''
-    Converts an RGB value to xyz coordinates, based on matrix transformations
-    of colorspace values here (Wide Gamut RGB):
-    http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
+    Converts an RGB value to xy coordinates, using the RGB2XYZ matrix
+    and normalizing the result. Black has no chromaticity, so it maps
+    to [0.0, 0.0].
     '''
-    X = 0.7161046 * r + 0.1009296 * g + 0.1471858 * b
-    Y = 0.2581874 * r + 0.7249378 * g + 0.0168748 * b
-    Z = 0.0000000 * r + 0.0517813 * g + 0.7734287 * b
-    x = X / (X+Y+Z)
-    y = Y / (X+Y+Z)
+    X, Y, Z = [m_r * r + m_g * g + m_b * b for (m_r, m_g, m_b) in RGB2XYZ]
+    total = X + Y + Z
+    if total == 0:
+        return [0.0, 0.0]
+    return [X / total, Y / total]
+
+def xy_type(value):
+    '''
+    Converts and validates the xy param, which must be a list of two numbers
+    between 0.0 and 1.0 (inclusive). This is used as the argument_spec type,
+    so the check is done once when the module params are loaded.
+    '''
+    if not isinstance(value, (list, tuple)):
+        value = str(value).split(',')
+    try:
+        x, y = [float(v) for v in value]
+    except (TypeError, ValueError):
+        raise ValueError("Expected an array of 2 floating point values but got %s" % (value,))
+    if not (0.0 <= x <= 1.0 and 0.0 <= y <= 1.0):
+        raise ValueError("The x and y values must be between 0.0 and 1.0 (inclusive) but got %s" % (value,))
     return [x, y]
 
-def build_state(module, cur_state):
+def rgb_type(value):
     '''
-    Builds the state based on the module params and the current state
-    of the given light object from the Hue bridge.
+    Validates the rgb param, which must be a full RRGGBB hex string with an
+    optional leading '#'. Like xy_type(), this is used as the argument_spec
+    type so the check is done once when the module params are loaded.
     '''
+    value = str(value).lstrip('#')
+    try:
+        if len(value) != 6:
+            raise ValueError()
+        binascii.unhexlify(value)
+    except (TypeError, ValueError):
+        raise ValueError("Expected a hex string of the form RRGGBB but got %s" % (value,))
+    return value
+
+def get_color_mode(params):
+    '''
+    Works out which of the (mutually exclusive) ways of setting the color
+    is being used: 'hs' for hue/saturation, 'xy', 'rgb' or 'ct' for the
+    color temperature. Returns None when the color isn't being set.
+    '''
+    if params.get('hue') is not None or params.get('saturation') is not None:
+        return 'hs'
+    elif params.get('xy') is not None:
+        return 'xy'
+    elif params.get('rgb') is not None:
+        return 'rgb'
+    elif params.get('color_temp') is not None:
+        return 'ct'
+    return None
+
+def build_state(module, cur_state, color_mode):
+    '''
+    Builds the state based on the module params, the color mode and the
+    current state of the given light object from the Hue bridge.
+    '''
+    # By far the most common use is simply turning things on or off, in
+    # which case the 'on' state is all there is to compare
+    on = module.params.get('on')
+    if all(module.params.get(param) is None for param in OPTIONAL_PARAMS):
+        return (cur_state.get('on') != on, dict(on=on))
+
     thing_state = dict()
 
     # set the 'on' state
-    thing_state['on'] = module.params.get('on')
-
-    # set the brightness
-    bri = module.params.get('brightness', None)
-    if bri is not None:
-        thing_state['bri'] = bri
-
-    # set the alert
-    alert = module.params.get('alert', None)
-    if alert is not None:
-        alert = alert.lower()
-        if alert not in ('none', 'select', 'lselect'):
-            module.fail_json(msg="The alert setting must be one of the following values: none, select or lselect")
-        thing_state['alert'] = alert
-
-    # set the effect
-    effect = module.params.get('effect', None)
-    if effect is not None:
-        effect = effect.lower()
-        if effect not in ('none', 'colorloop'):
-            module.fail_json(msg="The effect setting must be one of the following values: none or colorloop")
-        thing_state['effect'] = effect
-
-    # set the transition time
-    transition_time = module.params.get('transition_time', None)
-    if transition_time is not None:
-        thing_state['transitiontime'] = transition_time
-
-    # Figure out which color mode we're using...
-    if 'hue' in module.params or 'saturation' in module.params:
-        hue = module.params.get('hue', None)
+    thing_state['on'] = on
+
+    # set the brightness, alert, effect and transition time. The values
+    # have already been validated against the argument_spec choices.
+    for param, field in PARAM_FIELDS:
+        value = module.params.get(param)
+        if value is not None:
+            thing_state[field] = value
+
+    # Set the color, using whichever color mode was picked in main()
+    if color_mode == 'hs':
+        hue = module.params.get('hue')
         if hue is not None:
             thing_state['hue'] = hue
-        sat = module.params.get('saturation', None)
+        sat = module.params.get('saturation')
         if sat is not None:
             thing_state['sat'] = sat
-    elif 'xy' in module.params or 'rgb' in module.params:
-        if 'rgb' in module.params:
-            # The Hue doesn't support RGB by default, and python-hue does
-            # the conversion internally. So to make sure we can preserve
-            # idempotency we do the conversion calculation ourselves
-            try:
-                x, y = rgb2xyz(hex2rgb(module.params['rgb']))
-            except:
-                module.fail_json(msg="Invalid RGB hex string: %s" % module.params['rgb'])
-        else:
-            try:
-                x, y = module.params['xy']
-                assert isinstance(x, (int, float)) and x >= 0.0 and x <= 1.0
-                assert isinstance(y, (int, float)) and y >= 0.0 and y <= 1.0
-            except:
-                module.fail_json(msg="Invalid xy value. Expected an array of 2 floating point values (0.0 >= [x,y] >= 1.0) but got %s" % (module.params['xy'],))
-
-        thing_state['xy'] = [x, y]
-    elif 'color_temp' in module.params:
+    elif color_mode == 'xy':
+        # already validated by xy_type()
+        thing_state['xy'] = list(module.params['xy'])
+    elif color_mode == 'rgb':
+        # The Hue doesn't support RGB by default, and python-hue does
+        # the conversion internally. So to make sure we can preserve
+        # idempotency we do the conversion calculation ourselves. The
+        # value has already been validated by rgb_type().
+        thing_state['xy'] = rgb2xy(*hex2rgb(module.params['rgb']))
+    elif color_mode == 'ct':
         ct = module.params['color_temp']
         if ct < 153 or ct > 500:
-            module.warning('The color temperature specified (%d) may be outside of the recommend range (153-500) listed in the Hue API documentation' % ct)
+            module.warn('The color temperature specified (%d) may be outside of the recommend range (153-500) listed in the Hue API documentation' % ct)
         thing_state['ct'] = ct
 
     # Test to see if any fields changed. We only test those set in
     # the global constant as we don't want to set any fields outside
     # of those        
-    changed = False
-    for field in STATE_FIELDS:
-        if field in thing_state and cur_state.get(field) != thing_state.get(field):
-            changed = True
-            break
+    changed = any(cur_state.get(field) != value for field, value in iteritems(thing_state) if field in STATE_FIELDS)
 
     return (changed, thing_state)
 
@@ -217,9 +258,9 @@ def main():
             brightness=dict(type='int'),
             hue=dict(type='int'),
             saturation=dict(type='int'),
-            xy=dict(type='list'),
+            xy=dict(type=xy_type),
             color_temp=dict(type='int'),
-            rgb=dict(type='str'),
+            rgb=dict(type=rgb_type),
             alert=dict(type='str', choices=['none', 'select', 'lselect']),
             effect=dict(type='str', choices=['none', 'colorloop']),
             transition_time=dict(type='int'),
@@ -233,7 +274,7 @@ def main():
     try:
         hue = Hue(bridge=module.params['bridge'])
         hue_config = hue.get_config()
-    except Exception, e:
+    except Exception as e:
         module.fail_json(msg="Failed to connect to the Hue bridge. Make sure you've registered with it first using the hue_register module. Error was: %s" % str(e))
 
     # set initial flags
@@ -244,67 +285,60 @@ def main():
     thing_id = module.params['id']
     thing_name = module.params['name']
     if thing_id is None and thing_name != 'all':
-        # search lights and then groups for something with 'name'
-        for light_id, light_config in iter(hue_config.get('lights', {}).items()):
-            if light_config.get('name') == thing_name:
-                thing_id = "l%s" % light_id
-                break
-        else:
-            for group_id, group_config in iter(hue_config.get('groups', {}).items()):
-                if group_config.get('name') == thing_name:
-                    thing_id = "g%s" % group_id
-                    break
-            else:
-                module.fail_json(msg="There is no light or group on the Hue bridge named '%s'" % thing_name)
+        # look up the light (or failing that, the group) with 'name'
+        thing_id = hue.find_by_name(thing_name, hue_config)
+        if thing_id is None:
+            module.fail_json(msg="There is no light or group on the Hue bridge named '%s'" % thing_name)
 
-    # Compile the state (or list of states when using 'all' for the light name).
-    # The final_states dict will hold the final state of each light
-    target_states = dict()
-    final_states = dict()
-
-    # First we build the list of lights we're going to check
+    # The special name (or id) 'all' is an alias for group 0, which contains
+    # all of the lights connected to the bridge. Otherwise we make sure the
+    # light or group is one the bridge knows about.
     if thing_name == 'all' or thing_id == 'g0' or thing_id == 'all':
-        ids_to_check = [ "g0" ]
+        thing_id = 'g0'
+        thing_state = None
     else:
         real_id = thing_id[1:]
         if thing_id.startswith('l'):
-            the_thing = hue_config.get('lights', {}).get(real_id)
+            thing_state = hue_config.get('lights', {}).get(real_id)
         elif thing_id.startswith('g'):
-            the_thing = hue_config.get('groups', {}).get(real_id) 
+            thing_state = hue_config.get('groups', {}).get(real_id)
         else:
             module.fail_json(msg="Invalid light or group name: '%s'" % (thing_name or thing_id,))
-            
-        if the_thing is None:
+
+        if thing_state is None:
             module.fail_json(msg="Failed to find light or group '%s'. Make sure that the light was turned on." % (thing_name or thing_id,))
+
+    # The final_states dict will hold the final state of the light or group
+    final_states = dict()
+
+    # Then we fetch the current state and build the desired state (assuming
+    # the light is reachable). If we don't end up changing anything, the state
+    # fetched here is the final state. In check mode nothing will be written,
+    # so the state in the bridge config we already have is good enough and we
+    # don't ask the bridge again. Group 0 isn't in the config, so it's always
+    # fetched.
+    if thing_state is None or not module.check_mode:
+        thing_state = hue.get_state(thing_id)
+    final_states[thing_id] = thing_state
+
+    if not thing_state.get('state', {}).get('reachable', True):
+        failed = True
+    else:
+        if thing_id.startswith('l'):
+            cur_state = thing_state.get('state')
         else:
-            ids_to_check = [ thing_id ]
-
-    # Then, for each light in the list, fetch the current state and build
-    # the desired state (assuming the light is reachable)
-    for _id in ids_to_check:
-        thing_state = hue.get_state(_id)
-        if not thing_state.get('state', {}).get('reachable', True):
-            final_states[_id] = thing_state
-            failed = True
-        else:
-            if _id.startswith('l'):
-                thing_state = thing_state.get('state')
-            elif _id.startswith('g'):
-                thing_state = thing_state.get('action')
-
-            state_changed, desired_state = build_state(module, thing_state)
-            changed |= state_changed
-            target_states[_id] = desired_state
-
-    # Next, we set the state of each light as requested above
-    for target_thing, target_state in iter(target_states.items()):
-        if not module.check_mode and len(target_state) > 0:
-            # get the light and set the state
-            result = hue.set_state(target_thing, target_state)
-            failed = not hue.check_success(result)
-
-        # save the state for the final module result
-        final_states[target_thing] = hue.get_state(target_thing)
+            cur_state = thing_state.get('action')
+
+        changed, desired_state = build_state(module, cur_state, get_color_mode(module.params))
+        if changed and not module.check_mode:
+            # The bridge replies with the fields it applied, so we only need
+            # to fetch the state again if something went wrong.
+            result = hue.set_state(thing_id, desired_state)
+            if hue.check_success(result):
+                final_states[thing_id] = hue.merge_result(thing_id, thing_state, result)
+            else:
+                failed = True
+                final_states[thing_id] = hue.get_state(thing_id)
 
     # If one or more lights failed, fail the module, otherwise return
     # whether or not we changed. In both cases, we return the state of
@@ -16,6 +16,7 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import hashlib
+import random
 import socket
 import time
 
@@ -25,6 +26,23 @@ try:
 except ImportError:
     HAS_JSON = False
 
+# orjson is a good deal faster than the stdlib json module at encoding
+# and decoding, so it is used for talking to the bridge when available
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# The token only depends on the host we're running on, so it's computed once
+# when the module is loaded. The token code here is copied from python-hue:
+# https://github.com/issackelly/python-hue/blob/master/hue/hue.py
+try:
+    _fqdn = socket.getfqdn()
+except socket.error:
+    _fqdn = socket.gethostname()
+HUE_TOKEN = hashlib.md5(("ph-%s" % _fqdn).encode('utf-8')).hexdigest()
+
 DOCUMENTATION = '''
 ---
 module: hue_register
@@ -46,7 +64,8 @@ options:
   retry_time:
     default: 5
     descript:
-    - "The time in seconds to wait before attempting the next retry after failure to authenticate."
+    - "The maximum time in seconds to wait before attempting the next retry after failure to authenticate."
+    - "The wait starts at one second and doubles after each failed attempt (plus up to a second of random jitter), until it reaches this value."
 '''
 
 EXAMPLES = '''
@@ -56,24 +75,44 @@ EXAMPLES = '''
 
 '''
 
+def load_json(res):
+    '''
+    Decodes the JSON body of a response from the bridge.
+    '''
+    if HAS_ORJSON:
+        return orjson.loads(res.read())
+    return json.load(res)
+
 class Hue(object):
+    __slots__ = ('bridge', 'token', '_base')
+
     def __init__(self, bridge):
         self.bridge = bridge
-
-        # the token code here is copied from python-hue
-        # https://github.com/issackelly/python-hue/blob/master/hue/hue.py
-        self.token = hashlib.md5("ph-%s" % socket.getfqdn()).hexdigest()
+        self.token = HUE_TOKEN
+        self._base = 'http://%s/api/%s' % (self.bridge, self.token)
 
     def get_config(self):
-        url = 'http://%s/api/%s' % (self.bridge, self.token)
+        url = self._base
         res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+        return load_json(res)
+
+    def ping(self):
+        '''
+        Checks whether we're already registered with the bridge. Rather than
+        downloading the full bridge config, this only fetches the (small)
+        config section. The bridge answers that for anyone, but only includes
+        the whitelist of registered users when the token is one of them.
+        '''
+        url = '%s/config' % self._base
+        res = open_url(url, method='GET', timeout=2)
+        config = load_json(res)
+        return isinstance(config, dict) and 'whitelist' in config
 
     def create_user(self):
         url = 'http://%s/api' % (self.bridge,)
         data = dict(devicetype="python-hue", username=self.token)
-        res = open_url(url, data=json.dumps(data), method='POST', timeout=5)
-        return json.load(res)
+        res = open_url(url, data=orjson.dumps(data) if HAS_ORJSON else json.dumps(data), method='POST', timeout=2)
+        return load_json(res)
 
 def main():
 
@@ -93,13 +132,15 @@ def main():
     changed = False
     try:
         hue = Hue(bridge=module.params['bridge'])
-        hue_config = hue.get_config()
-        if isinstance(hue_config, list) and 'error' in hue_config[0]:
+        if not hue.ping():
             raise Exception("")
+        # the full config is only fetched when we've just registered
+        hue_config = None
         message = "Already authenticated"
     except:
         num_retries = module.params.get('retries')
         retry_time  = module.params.get('retry_time')
+        attempts    = 0
         while num_retries >= 0:
             try:
                 res = hue.create_user()
@@ -109,9 +150,12 @@ def main():
                 message = "Hue bridge authentication successful."
                 changed = True
                 break
-            except Exception, e:
+            except Exception as e:
+                # back off exponentially, with some jitter so that several
+                # hosts registering at once don't poll the bridge in lockstep
                 if num_retries > 0:
-                    time.sleep(retry_time)
+                    time.sleep(min(2 ** attempts, retry_time) + random.uniform(0, 1))
+                attempts += 1
                 num_retries -= 1
                 continue
 
@@ -1,53 +1,163 @@
+import errno
 import hashlib
 import socket
 import time
 
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
 try:
     import json
     HAS_JSON = True
 except ImportError:
     HAS_JSON = False
 
+# orjson is a good deal faster than the stdlib json module at encoding
+# and decoding, so it is used for talking to the bridge when available
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# dict.items() builds a whole list of (key, value) pairs on python 2, so
+# we use iteritems() where it exists instead
+try:
+    iteritems = dict.iteritems
+except AttributeError:
+    iteritems = dict.items
+
+# The token only depends on the host we're running on, so it's computed once
+# when the module is loaded. The token code here is copied from python-hue:
+# https://github.com/issackelly/python-hue/blob/master/hue/hue.py
+try:
+    _fqdn = socket.getfqdn()
+except socket.error:
+    _fqdn = socket.gethostname()
+HUE_TOKEN = hashlib.md5(("ph-%s" % _fqdn).encode('utf-8')).hexdigest()
+
+# The API paths used to fetch and update the state of a target, keyed on
+# the first character of the target id ('l' for lights, 'g' for groups)
+GET_STATE_PATHS = {'l': '/lights/%s', 'g': '/groups/%s'}
+SET_STATE_PATHS = {'l': '/lights/%s/state', 'g': '/groups/%s/action'}
+
+def connection_dropped(e):
+    '''
+    Returns whether an error raised while sending a request means the bridge
+    closed the persistent connection on us, as opposed to the bridge being
+    unreachable or too slow to answer (in which case it may well have acted
+    on the request already).
+    '''
+    # RemoteDisconnected, raised on python 3, is a subclass of BadStatusLine
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
 class Hue(object):
+    __slots__ = (
+        'bridge', 'token', '_base', '_get_state_urls', '_set_state_urls',
+        '_conn', '_names',
+    )
+
     def __init__(self, bridge):
         self.bridge = bridge
+        self.token = HUE_TOKEN
+        self._base = '/api/%s' % self.token
+
+        # the URLs for a target only vary by the target id, so the rest of
+        # each URL is built once here rather than on every request
+        self._get_state_urls = dict((kind, self._base + path) for kind, path in iteritems(GET_STATE_PATHS))
+        self._set_state_urls = dict((kind, self._base + path) for kind, path in iteritems(SET_STATE_PATHS))
+
+        # a single connection to the bridge is kept open and reused for
+        # every request made through this object
+        self._conn = httplib.HTTPConnection(self.bridge, timeout=5)
 
-        # the token code here is copied from python-hue
-        # https://github.com/issackelly/python-hue/blob/master/hue/hue.py
-        self.token = hashlib.md5("ph-%s" % socket.getfqdn()).hexdigest()
+        # the index of light and group names, built by find_by_name()
+        self._names = None
+
+    def _request(self, method, path, data=None):
+        '''
+        Sends a request to the bridge over the persistent connection and
+        returns the decoded JSON response. Some bridges ignore keep-alive
+        and close the socket between requests, so we reconnect and retry
+        once if the connection was dropped. Any other error (including a
+        timeout) is raised straight away.
+        '''
+        if data is not None:
+            data = orjson.dumps(data) if HAS_ORJSON else json.dumps(data)
+        headers = {'Connection': 'keep-alive', 'Content-Type': 'application/json'}
+        try:
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            if not connection_dropped(e):
+                raise
+            self._conn.close()
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+
+        # the bridge always sends a Content-Length, so read the whole body
+        # in one go rather than letting the response buffer it piecemeal
+        length = res.getheader('Content-Length')
+        body = res.read(int(length)) if length else res.read()
+        if HAS_ORJSON:
+            return orjson.loads(body)
+        return json.loads(body)
 
     def check_success(self, result):
-        for status in result:
-            if 'failed' in status.keys():
-                return False
-        return True
+        # the bridge reports each field it couldn't set as {"error": {...}}
+        return not any('error' in status for status in result)
 
     def get_config(self):
-        url = 'http://%s/api/%s' % (self.bridge, self.token)
-        res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+        return self._request('GET', self._base)
 
-    def get_state(self, target):
-        real_target = target[1:]
-        if target.startswith('l'):
-            url = 'http://%s/api/%s/lights/%s' % (self.bridge, self.token, real_target)
-        elif target.startswith('g'):
-            url = 'http://%s/api/%s/groups/%s' % (self.bridge, self.token, real_target)
-        else:
+    def _target_url(self, urls, target):
+        try:
+            return urls[target[0]] % target[1:]
+        except (KeyError, IndexError):
             raise Exception("Invalid target: %s" % target)
 
-        res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+    def get_state(self, target):
+        return self._request('GET', self._target_url(self._get_state_urls, target))
 
     def set_state(self, target, state):
-        real_target = target[1:]
-        if target.startswith('l'):
-            url = 'http://%s/api/%s/lights/%s/state' % (self.bridge, self.token, real_target)
-        elif target.startswith('g'):
-            url = 'http://%s/api/%s/groups/%s/action' % (self.bridge, self.token, real_target)
-        else:
-            raise Exception("Invalid target: %s" % target)
+        return self._request('PUT', self._target_url(self._set_state_urls, target), data=state)
+
+    def find_by_name(self, name, config):
+        '''
+        Returns the id ('lX' or 'gX') of the light or group with the given
+        name in the bridge config, or None if there isn't one. Lights take
+        precedence over groups with the same name. The name index is only
+        built the first time this is called.
+        '''
+        if self._names is None:
+            names = dict()
+            for group_id, group_config in iteritems(config.get('groups') or {}):
+                names[group_config.get('name')] = 'g%s' % group_id
+            for light_id, light_config in iteritems(config.get('lights') or {}):
+                names[light_config.get('name')] = 'l%s' % light_id
+            self._names = names
+        return self._names.get(name)
 
-        res = open_url(url, data=json.dumps(state), method='PUT', timeout=5)
-        return json.load(res)
+    def merge_result(self, target, thing_state, result):
+        '''
+        Returns a copy of the given state of a target, updated with the
+        fields the bridge reported as successfully set in the result of a
+        set_state() call. This saves fetching the state again after the
+        target has been updated. Only fields already in the state are
+        updated, as some (like transitiontime) are never reported back.
+        '''
+        section = 'state' if target.startswith('l') else 'action'
+        merged = dict(thing_state)
+        merged[section] = dict(thing_state.get(section, {}))
+        for status in result:
+            # successful results look like {"/lights/1/state/bri": 254}
+            for path, value in iteritems(status.get('success', {})):
+                field = path.rsplit('/', 1)[-1]
+                if field in merged[section]:
+                    merged[section][field] = value
+        return merged
 
@@ -16,16 +16,38 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import errno
 import hashlib
 import socket
 import time
 
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
 try:
     import json
     HAS_JSON = True
 except ImportError:
     HAS_JSON = False
 
+# orjson is a good deal faster than the stdlib json module at encoding
+# and decoding, so it is used for talking to the bridge when available
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# dict.items() builds a whole list of (key, value) pairs on python 2, so
+# we use iteritems() where it exists instead
+try:
+    iteritems = dict.iteritems
+except AttributeError:
+    iteritems = dict.items
+
 DOCUMENTATION = '''
 ---
 module: hue
@@ -115,21 +137,100 @@ EXAMPLES = '''
     brightness: 128
 '''
 
-STATE_FIELDS = ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect',)
+STATE_FIELDS = frozenset(('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect',))
+
+# module params which are copied as-is to a field of the state
+PARAM_FIELDS = (
+    ('brightness', 'bri'),
+    ('alert', 'alert'),
+    ('effect', 'effect'),
+    ('transition_time', 'transitiontime'),
+)
+
+# every module param which sets part of the state, other than 'on'
+OPTIONAL_PARAMS = ('brightness', 'alert', 'effect', 'transition_time', 'hue', 'saturation', 'xy', 'rgb', 'color_temp',)
+
+# The token only depends on the host we're running on, so it's computed once
+# when the module is loaded. The token code here is copied from python-hue:
+# https://github.com/issackelly/python-hue/blob/master/hue/hue.py
+try:
+    _fqdn = socket.getfqdn()
+except socket.error:
+    _fqdn = socket.gethostname()
+HUE_TOKEN = hashlib.md5(("ph-%s" % _fqdn).encode('utf-8')).hexdigest()
+
+# The API paths used to fetch and update the state of a target, keyed on
+# the first character of the target id ('l' for lights, 'g' for groups)
+GET_STATE_PATHS = {'l': '/lights/%s', 'g': '/groups/%s'}
+SET_STATE_PATHS = {'l': '/lights/%s/state', 'g': '/groups/%s/action'}
+
+def connection_dropped(e):
+    '''
+    Returns whether an error raised while sending a request means the bridge
+    closed the persistent connection on us, as opposed to the bridge being
+    unreachable or too slow to answer (in which case it may well have acted
+    on the request already).
+    '''
+    # RemoteDisconnected, raised on python 3, is a subclass of BadStatusLine
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
 
 class Hue(object):
+    __slots__ = (
+        'bridge', 'token', '_base', '_get_state_urls', '_set_state_urls',
+        '_conn', '_names',
+    )
+
     def __init__(self, bridge):
         self.bridge = bridge
-
-        # the token code here is copied from python-hue
-        # https://github.com/issackelly/python-hue/blob/master/hue/hue.py
-        self.token = hashlib.md5("ph-%s" % socket.getfqdn()).hexdigest()
+        self.token = HUE_TOKEN
+        self._base = '/api/%s' % self.token
+
+        # the URLs for a target only vary by the target id, so the rest of
+        # each URL is built once here rather than on every request
+        self._get_state_urls = dict((kind, self._base + path) for kind, path in iteritems(GET_STATE_PATHS))
+        self._set_state_urls = dict((kind, self._base + path) for kind, path in iteritems(SET_STATE_PATHS))
+
+        # a single connection to the bridge is kept open and reused for
+        # every request made through this object
+        self._conn = httplib.HTTPConnection(self.bridge, timeout=5)
+
+        # the index of light and group names, built by find_by_name()
+        self._names = None
+
+    def _request(self, method, path, data=None):
+        '''
+        Sends a request to the bridge over the persistent connection and
+        returns the decoded JSON response. Some bridges ignore keep-alive
+        and close the socket between requests, so we reconnect and retry
+        once if the connection was dropped. Any other error (including a
+        timeout) is raised straight away.
+        '''
+        if data is not None:
+            data = orjson.dumps(data) if HAS_ORJSON else json.dumps(data)
+        headers = {'Connection': 'keep-alive', 'Content-Type': 'application/json'}
+        try:
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            if not connection_dropped(e):
+                raise
+            self._conn.close()
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+
+        # the bridge always sends a Content-Length, so read the whole body
+        # in one go rather than letting the response buffer it piecemeal
+        length = res.getheader('Content-Length')
+        body = res.read(int(length)) if length else res.read()
+        if HAS_ORJSON:
+            return orjson.loads(body)
+        return json.loads(body)
 
     def check_success(self, result):
-        for status in result:
-            if 'failed' in status.keys():
-                return False
-        return True
+        # the bridge reports each field it couldn't set as {"error": {...}}
+        return not any('error' in status for status in result)
 
     def check_error(self, result):
         if isinstance(result, list) and 'error' in result[0]:
@@ -137,133 +238,179 @@ class Hue(object):
         return result
 
     def get_config(self):
-        url = 'http://%s/api/%s' % (self.bridge, self.token)
-        res = open_url(url, method='GET', timeout=5)
-        return self.check_error(json.load(res))
+        return self.check_error(self._request('GET', self._base))
 
-    def get_state(self, target):
-        real_target = target[1:]
-        if target.startswith('l'):
-            url = 'http://%s/api/%s/lights/%s' % (self.bridge, self.token, real_target)
-        elif target.startswith('g'):
-            url = 'http://%s/api/%s/groups/%s' % (self.bridge, self.token, real_target)
-        else:
+    def _target_url(self, urls, target):
+        try:
+            return urls[target[0]] % target[1:]
+        except (KeyError, IndexError):
             raise Exception("Invalid target: %s" % target)
 
-        res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+    def get_state(self, target):
+        return self._request('GET', self._target_url(self._get_state_urls, target))
 
     def set_state(self, target, state):
-        real_target = target[1:]
-        if target.startswith('l'):
-            url = 'http://%s/api/%s/lights/%s/state' % (self.bridge, self.token, real_target)
-        elif target.startswith('g'):
-            url = 'http://%s/api/%s/groups/%s/action' % (self.bridge, self.token, real_target)
-        else:
-            raise Exception("Invalid target: %s" % target)
-
-        res = open_url(url, data=json.dumps(state), method='PUT', timeout=5)
-        return json.load(res)
+        return self._request('PUT', self._target_url(self._set_state_urls, target), data=state)
+
+    def find_by_name(self, name, config):
+        '''
+        Returns the id ('lX' or 'gX') of the light or group with the given
+        name in the bridge config, or None if there isn't one. Lights take
+        precedence over groups with the same name. The name index is only
+        built the first time this is called.
+        '''
+        if self._names is None:
+            names = dict()
+            for group_id, group_config in iteritems(config.get('groups') or {}):
+                names[group_config.get('name')] = 'g%s' % group_id
+            for light_id, light_config in iteritems(config.get('lights') or {}):
+                names[light_config.get('name')] = 'l%s' % light_id
+            self._names = names
+        return self._names.get(name)
+
+    def merge_result(self, target, thing_state, result):
+        '''
+        Returns a copy of the given state of a target, updated with the
+        fields the bridge reported as successfully set in the result of a
+        set_state() call. This saves fetching the state again after the
+        target has been updated. Only fields already in the state are
+        updated, as some (like transitiontime) are never reported back.
+        '''
+        section = 'state' if target.startswith('l') else 'action'
+        merged = dict(thing_state)
+        merged[section] = dict(thing_state.get(section, {}))
+        for status in result:
+            # successful results look like {"/lights/1/state/bri": 254}
+            for path, value in iteritems(status.get('success', {})):
+                field = path.rsplit('/', 1)[-1]
+                if field in merged[section]:
+                    merged[section][field] = value
+        return merged
+
+# The Wide Gamut RGB to XYZ conversion matrix, from the colorspace values here:
+# http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
+RGB2XYZ = (
+    (0.7161046, 0.1009296, 0.1471858),
+    (0.2581874, 0.7249378, 0.0168748),
+    (0.0000000, 0.0517813, 0.7734287),
+)
 
 def hex2rgb(hex):
     '''
-    Converts a hex string to an RGB value.
+    Converts a hex string to an RGB value. The string is expected to have
+    already been validated by rgb_type().
     '''
-    hex = hex.lstrip('#')
-    assert len(hex) == 6
-    return (int(hex[0:2], 16), int(hex[2:4], 16), int(hex[4:6], 16))
+    return tuple(bytearray.fromhex(hex.lstrip('#')))
 
 def rgb2xy(r, g, b):
     '''
-    Converts an RGB value to xyz coordinates, based on matrix transformations
-    of colorspace values here (Wide Gamut RGB):
-    http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
+    Converts an RGB value to xy coordinates, using the RGB2XYZ matrix
+    and normalizing the result. Black has no chromaticity, so it maps
+    to [0.0, 0.0].
+    '''
+    X, Y, Z = [m_r * r + m_g * g + m_b * b for (m_r, m_g, m_b) in RGB2XYZ]
+    total = X + Y + Z
+    if total == 0:
+        return [0.0, 0.0]
+    return [X / total, Y / total]
+
+def xy_type(value):
     '''
-    X = 0.7161046 * r + 0.1009296 * g + 0.1471858 * b
-    Y = 0.2581874 * r + 0.7249378 * g + 0.0168748 * b
-    Z = 0.0000000 * r + 0.0517813 * g + 0.7734287 * b
-    x = X / (X+Y+Z)
-    y = Y / (X+Y+Z)
+    Converts and validates the xy param, which must be a list of two numbers
+    between 0.0 and 1.0 (inclusive). This is used as the argument_spec type,
+    so the check is done once when the module params are loaded.
+    '''
+    if not isinstance(value, (list, tuple)):
+        value = str(value).split(',')
+    try:
+        x, y = [float(v) for v in value]
+    except (TypeError, ValueError):
+        raise ValueError("Expected an array of 2 floating point values but got %s" % (value,))
+    if not (0.0 <= x <= 1.0 and 0.0 <= y <= 1.0):
+        raise ValueError("The x and y values must be between 0.0 and 1.0 (inclusive) but got %s" % (value,))
     return [x, y]
 
-def build_state(module, cur_state):
+def rgb_type(value):
     '''
-    Builds the state based on the module params and the current state
-    of the given light object from the Hue bridge.
+    Validates the rgb param, which must be a full RRGGBB hex string with an
+    optional leading '#'. Like xy_type(), this is used as the argument_spec
+    type so the check is done once when the module params are loaded.
     '''
+    value = str(value).lstrip('#')
+    try:
+        if len(value) != 6:
+            raise ValueError()
+        binascii.unhexlify(value)
+    except (TypeError, ValueError):
+        raise ValueError("Expected a hex string of the form RRGGBB but got %s" % (value,))
+    return value
+
+def get_color_mode(params):
+    '''
+    Works out which of the (mutually exclusive) ways of setting the color
+    is being used: 'hs' for hue/saturation, 'xy', 'rgb' or 'ct' for the
+    color temperature. Returns None when the color isn't being set.
+    '''
+    if params.get('hue') is not None or params.get('saturation') is not None:
+        return 'hs'
+    elif params.get('xy') is not None:
+        return 'xy'
+    elif params.get('rgb') is not None:
+        return 'rgb'
+    elif params.get('color_temp') is not None:
+        return 'ct'
+    return None
+
+def build_state(module, cur_state, color_mode):
+    '''
+    Builds the state based on the module params, the color mode and the
+    current state of the given light object from the Hue bridge.
+    '''
+    # By far the most common use is simply turning things on or off, in
+    # which case the 'on' state is all there is to compare
+    on = module.params.get('on')
+    if all(module.params.get(param) is None for param in OPTIONAL_PARAMS):
+        return (cur_state.get('on') != on, dict(on=on))
+
     thing_state = dict()
 
     # set the 'on' state
-    thing_state['on'] = module.params.get('on')
-
-    # set the brightness
-    bri = module.params.get('brightness', None)
-    if bri is not None:
-        thing_state['bri'] = bri
-
-    # set the alert
-    alert = module.params.get('alert', None)
-    if alert is not None:
-        alert = alert.lower()
-        if alert not in ('none', 'select', 'lselect'):
-            module.fail_json(msg="The alert setting must be one of the following values: none, select or lselect")
-        thing_state['alert'] = alert
-
-    # set the effect
-    effect = module.params.get('effect', None)
-    if effect is not None:
-        effect = effect.lower()
-        if effect not in ('none', 'colorloop'):
-            module.fail_json(msg="The effect setting must be one of the following values: none or colorloop")
-        thing_state['effect'] = effect
-
-    # set the transition time
-    transition_time = module.params.get('transition_time', None)
-    if transition_time is not None:
-        thing_state['transitiontime'] = transition_time
-
-    # Figure out which color mode we're using...
-    hue = module.params.get('hue', None)
-    sat = module.params.get('saturation', None)
-    rgb = module.params.get('rgb', None)
-    xy  = module.params.get('xy', None)
-    ct  = module.params.get('ct', None)
-
-    if hue is not None or sat is not None:
+    thing_state['on'] = on
+
+    # set the brightness, alert, effect and transition time. The values
+    # have already been validated against the argument_spec choices.
+    for param, field in PARAM_FIELDS:
+        value = module.params.get(param)
+        if value is not None:
+            thing_state[field] = value
+
+    # Set the color, using whichever color mode was picked in main()
+    if color_mode == 'hs':
+        hue = module.params.get('hue')
         if hue is not None:
             thing_state['hue'] = hue
+        sat = module.params.get('saturation')
         if sat is not None:
             thing_state['sat'] = sat
-    elif rgb is not None or xy is not None:
-        x, y = 0.0, 0.0
-        if rgb is not None:
-            # The Hue doesn't support RGB by default, and python-hue does
-            # the conversion internally. So to make sure we can preserve
-            # idempotency we do the conversion calculation ourselves
-            try:
-                x, y = rgb2xy(*hex2rgb(rgb))
-            except Exception as e:
-                module.fail_json(msg="Invalid RGB hex string: %s (%s)" % (rgb, e))
-        elif xy is not None:
-            try:
-                x, y = xy
-            except:
-                module.fail_json(msg="Invalid xy value. Expected an array of 2 floating point values (0.0 >= [x,y] >= 1.0) but got %s" % (xy,))
-
-        thing_state['xy'] = [x, y]
-    elif ct is not None:
+    elif color_mode == 'xy':
+        # already validated by xy_type()
+        thing_state['xy'] = list(module.params['xy'])
+    elif color_mode == 'rgb':
+        # The Hue doesn't support RGB by default, and python-hue does
+        # the conversion internally. So to make sure we can preserve
+        # idempotency we do the conversion calculation ourselves. The
+        # value has already been validated by rgb_type().
+        thing_state['xy'] = rgb2xy(*hex2rgb(module.params['rgb']))
+    elif color_mode == 'ct':
+        ct = module.params['color_temp']
         if ct < 153 or ct > 500:
-            module.warning('The color temperature specified (%d) may be outside of the recommend range (153-500) listed in the Hue API documentation' % ct)
+            module.warn('The color temperature specified (%d) may be outside of the recommend range (153-500) listed in the Hue API documentation' % ct)
         thing_state['ct'] = ct
 
     # Test to see if any fields changed. We only test those set in
     # the global constant as we don't want to set any fields outside
     # of those        
-    changed = False
-    for field in STATE_FIELDS:
-        if field in thing_state and cur_state.get(field) != thing_state.get(field):
-            changed = True
-            break
+    changed = any(cur_state.get(field) != value for field, value in iteritems(thing_state) if field in STATE_FIELDS)
 
     return (changed, thing_state)
 
@@ -278,9 +425,9 @@ def main():
             brightness=dict(type='int'),
             hue=dict(type='int'),
             saturation=dict(type='int'),
-            xy=dict(type='list'),
+            xy=dict(type=xy_type),
             color_temp=dict(type='int'),
-            rgb=dict(type='str'),
+            rgb=dict(type=rgb_type),
             alert=dict(type='str', choices=['none', 'select', 'lselect']),
             effect=dict(type='str', choices=['none', 'colorloop']),
             transition_time=dict(type='int'),
@@ -295,7 +442,7 @@ def main():
         hue = Hue(bridge=module.params['bridge'])
         hue_config = hue.get_config()
         print("The hue config is: %s" % hue_config)
-    except Exception, e:
+    except Exception as e:
         module.fail_json(msg="Failed to connect to the Hue bridge. Make sure you've registered with it first using the hue_register module. Error was: %s" % str(e))
 
     # set initial flags
@@ -306,67 +453,60 @@ def main():
     thing_id = module.params['id']
     thing_name = module.params['name']
     if thing_id is None and thing_name != 'all':
-        # search lights and then groups for something with 'name'
-        for light_id, light_config in iter(hue_config.get('lights', {}).items()):
-            if light_config.get('name') == thing_name:
-                thing_id = "l%s" % light_id
-                break
-        else:
-            for group_id, group_config in iter(hue_config.get('groups', {}).items()):
-                if group_config.get('name') == thing_name:
-                    thing_id = "g%s" % group_id
-                    break
-            else:
-                module.fail_json(msg="There is no light or group on the Hue bridge named '%s'" % thing_name)
-
-    # Compile the state (or list of states when using 'all' for the light name).
-    # The final_states dict will hold the final state of each light
-    target_states = dict()
-    final_states = dict()
-
-    # First we build the list of lights we're going to check
+        # look up the light (or failing that, the group) with 'name'
+        thing_id = hue.find_by_name(thing_name, hue_config)
+        if thing_id is None:
+            module.fail_json(msg="There is no light or group on the Hue bridge named '%s'" % thing_name)
+
+    # The special name (or id) 'all' is an alias for group 0, which contains
+    # all of the lights connected to the bridge. Otherwise we make sure the
+    # light or group is one the bridge knows about.
     if thing_name == 'all' or thing_id == 'g0' or thing_id == 'all':
-        ids_to_check = [ "g0" ]
+        thing_id = 'g0'
+        thing_state = None
     else:
         real_id = thing_id[1:]
         if thing_id.startswith('l'):
-            the_thing = hue_config.get('lights', {}).get(real_id)
+            thing_state = hue_config.get('lights', {}).get(real_id)
         elif thing_id.startswith('g'):
-            the_thing = hue_config.get('groups', {}).get(real_id) 
+            thing_state = hue_config.get('groups', {}).get(real_id)
         else:
             module.fail_json(msg="Invalid light or group name: '%s'" % (thing_name or thing_id,))
-            
-        if the_thing is None:
+
+        if thing_state is None:
             module.fail_json(msg="Failed to find light or group '%s'. Make sure that the light was turned on." % (thing_name or thing_id,))
+
+    # The final_states dict will hold the final state of the light or group
+    final_states = dict()
+
+    # Then we fetch the current state and build the desired state (assuming
+    # the light is reachable). If we don't end up changing anything, the state
+    # fetched here is the final state. In check mode nothing will be written,
+    # so the state in the bridge config we already have is good enough and we
+    # don't ask the bridge again. Group 0 isn't in the config, so it's always
+    # fetched.
+    if thing_state is None or not module.check_mode:
+        thing_state = hue.get_state(thing_id)
+    final_states[thing_id] = thing_state
+
+    if not thing_state.get('state', {}).get('reachable', True):
+        failed = True
+    else:
+        if thing_id.startswith('l'):
+            cur_state = thing_state.get('state')
         else:
-            ids_to_check = [ thing_id ]
-
-    # Then, for each light in the list, fetch the current state and build
-    # the desired state (assuming the light is reachable)
-    for _id in ids_to_check:
-        thing_state = hue.get_state(_id)
-        if not thing_state.get('state', {}).get('reachable', True):
-            final_states[_id] = thing_state
-            failed = True
-        else:
-            if _id.startswith('l'):
-                thing_state = thing_state.get('state')
-            elif _id.startswith('g'):
-                thing_state = thing_state.get('action')
-
-            state_changed, desired_state = build_state(module, thing_state)
-            changed |= state_changed
-            target_states[_id] = desired_state
-
-    # Next, we set the state of each light as requested above
-    for target_thing, target_state in iter(target_states.items()):
-        if not module.check_mode and len(target_state) > 0:
-            # get the light and set the state
-            result = hue.set_state(target_thing, target_state)
-            failed = not hue.check_success(result)
-
-        # save the state for the final module result
-        final_states[target_thing] = hue.get_state(target_thing)
+            cur_state = thing_state.get('action')
+
+        changed, desired_state = build_state(module, cur_state, get_color_mode(module.params))
+        if changed and not module.check_mode:
+            # The bridge replies with the fields it applied, so we only need
+            # to fetch the state again if something went wrong.
+            result = hue.set_state(thing_id, desired_state)
+            if hue.check_success(result):
+                final_states[thing_id] = hue.merge_result(thing_id, thing_state, result)
+            else:
+                failed = True
+                final_states[thing_id] = hue.get_state(thing_id)
 
     # If one or more lights failed, fail the module, otherwise return
     # whether or not we changed. In both cases, we return the state of
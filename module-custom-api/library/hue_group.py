@@ -16,17 +16,46 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import hashlib
 import re
 import socket
 import time
 
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
 try:
     import json
     HAS_JSON = True
 except ImportError:
     HAS_JSON = False
 
+# orjson is a good deal faster than the stdlib json module at encoding
+# and decoding, so it is used for talking to the bridge when available
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# light ids may be given as either str or unicode on python 2
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# The token only depends on the host we're running on, so it's computed once
+# when the module is loaded. The token code here is copied from python-hue:
+# https://github.com/issackelly/python-hue/blob/master/hue/hue.py
+try:
+    _fqdn = socket.getfqdn()
+except socket.error:
+    _fqdn = socket.gethostname()
+HUE_TOKEN = hashlib.md5(("ph-%s" % _fqdn).encode('utf-8')).hexdigest()
+
 DOCUMENTATION = '''
 ---
 module: hue_group
@@ -92,46 +121,92 @@ HUE_GROUP_CLASSES = [
     "Garage", "Terrace", "Garden", "Driveway", "Carport", "Other",
 ]
 
-STATE_FIELDS = ["name", "lights", "type", "class"]
+STATE_FIELDS = frozenset(["name", "lights", "type", "class"])
+
+# group ids may be given as either 'gX' or 'X', where X is the id on the bridge
+GROUP_ID_RE = re.compile(r'^g?([0-9]+)$')
+
+# the type of the error the bridge answers with when asked for something
+# which doesn't exist (as opposed to, say, an unauthorized user)
+RESOURCE_NOT_AVAILABLE = 3
+
+def connection_dropped(e):
+    '''
+    Returns whether an error raised while sending a request means the bridge
+    closed the persistent connection on us, as opposed to the bridge being
+    unreachable or too slow to answer (in which case it may well have acted
+    on the request already).
+    '''
+    # RemoteDisconnected, raised on python 3, is a subclass of BadStatusLine
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
 
 class Hue(object):
+    __slots__ = ('bridge', 'token', '_base', '_conn')
+
     def __init__(self, bridge):
         self.bridge = bridge
-
-        # the token code here is copied from python-hue
-        # https://github.com/issackelly/python-hue/blob/master/hue/hue.py
-        self.token = hashlib.md5("ph-%s" % socket.getfqdn()).hexdigest()
+        self.token = HUE_TOKEN
+        self._base = '/api/%s' % self.token
+
+        # a single connection to the bridge is kept open and reused for
+        # every request made through this object
+        self._conn = httplib.HTTPConnection(self.bridge, timeout=5)
+
+    def _request(self, method, path, data=None):
+        '''
+        Sends a request to the bridge over the persistent connection and
+        returns the decoded JSON response. Some bridges ignore keep-alive
+        and close the socket between requests, so we reconnect and retry
+        once if the connection was dropped. Any other error (including a
+        timeout) is raised straight away. POSTs are never retried, since the
+        bridge may have acted on the first attempt, so instead they are
+        always sent over a fresh connection.
+        '''
+        if data is not None:
+            data = orjson.dumps(data) if HAS_ORJSON else json.dumps(data)
+        headers = {'Connection': 'keep-alive', 'Content-Type': 'application/json'}
+        if method == 'POST':
+            self._conn.close()
+        try:
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            if method == 'POST' or not connection_dropped(e):
+                raise
+            self._conn.close()
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+        if HAS_ORJSON:
+            return orjson.loads(res.read())
+        return json.load(res)
 
     def check_success(self, result):
-        for status in result:
-            if 'error' in status.keys():
-                return False
-        return True
+        return not any('error' in status for status in result)
+
+    def check_error(self, result):
+        if isinstance(result, list) and 'error' in result[0]:
+            raise Exception(result[0]['error'].get('description', 'Unknown API Error'))
+        return result
 
     def get_config(self):
-        url = 'http://%s/api/%s' % (self.bridge, self.token)
-        res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+        return self._request('GET', self._base)
+
+    def get_groups(self):
+        return self._request('GET', '%s/groups' % self._base)
 
     def get_group_state(self, target):
-        url = 'http://%s/api/%s/groups/%s' % (self.bridge, self.token, target)
-        res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+        return self._request('GET', '%s/groups/%s' % (self._base, target))
 
     def create_group(self, state):
-        url = 'http://%s/api/%s/groups' % (self.bridge, self.token)
-        res = open_url(url, data=json.dumps(state), method='POST', timeout=5)
-        return json.load(res)
+        return self._request('POST', '%s/groups' % self._base, data=state)
 
     def update_group(self, target, state):
-        url = 'http://%s/api/%s/groups/%s' % (self.bridge, self.token, target)
-        res = open_url(url, data=json.dumps(state), method='PUT', timeout=5)
-        return json.load(res)
+        return self._request('PUT', '%s/groups/%s' % (self._base, target), data=state)
 
     def delete_group(self, target):
-        url = 'http://%s/api/%s/groups/%s' % (self.bridge, self.token, target)
-        res = open_url(url, method='DELETE', timeout=5)
-        return json.load(res)
+        return self._request('DELETE', '%s/groups/%s' % (self._base, target))
 
 
 def build_state(module, cur_state):
@@ -144,18 +219,26 @@ def build_state(module, cur_state):
         cur_state = dict()
 
     group_state = dict()
+    changed = False
+
+    # Sets a field in the new state, noting whether it differs from the
+    # current state. Only the fields in STATE_FIELDS count as changes, as
+    # we don't want to set any fields outside of those.
+    def set_field(field, value):
+        group_state[field] = value
+        return field in STATE_FIELDS and cur_state.get(field) != value
 
     name = module.params.get('name')
     if name is not None:
-        group_state['name'] = name
+        changed |= set_field('name', name)
 
     group_type = module.params.get('type')
     if group_type is not None:
-        group_state['type'] = group_type
+        changed |= set_field('type', group_type)
 
     group_class = module.params.get('class')
     if group_class is not None:
-        group_state['class'] = group_class
+        changed |= set_field('class', group_class)
 
     lights = module.params.get('lights')
     if lights is not None:
@@ -165,23 +248,14 @@ def build_state(module, cur_state):
         for light in lights:
            if isinstance(light, int):
                final_lights.append(str(light))
-           elif isinstance(light, basestring):
+           elif isinstance(light, string_types):
                if light.startswith('l'):
                    final_lights.append(light[1:])
                else:
                    final_lights.append(light)
            else:
                module.fail_json(msg="Invalid light id specified (%s, type %s) in the list of lights" % (light, type(light)))
-        group_state['lights'] = final_lights
-
-    # Test to see if any fields changed. We only test those set in
-    # the global constant as we don't want to set any fields outside
-    # of those        
-    changed = False
-    for field in STATE_FIELDS:
-        if field in group_state and cur_state.get(field) != group_state.get(field):
-            changed = True
-            break
+        changed |= set_field('lights', final_lights)
 
     return (changed, group_state)
 
@@ -205,35 +279,41 @@ def main():
     if not HAS_JSON:
         module.fail_json(msg="This module requires json.")
 
-    # create our custom Hue() object and validate we're talking to it
-    try:
-        hue = Hue(bridge=module.params['bridge'])
-        hue_config = hue.get_config()
-    except Exception, e:
-        module.fail_json(msg="Failed to connect to the Hue bridge. Make sure you've registered with it first using the hue_register module. Error was: %s" % str(e))
-
     # set initial flags
     changed = False
     failed  = False
 
-    # Get the targeted lights name from the module params. If no id is specified,
-    # we search through the groups for one matching the given group name.
     group_id = module.params['id']
     group_name = module.params['name']
     group_state = None
-    if group_id is None:
-        for _id, group_config in iter(hue_config.get('groups', {}).items()):
-            if group_config.get('name') == group_name:
-                group_id = _id
-                group_state = group_config
-                break
-    else:
-        matched_group = re.compile(r'^g?([0-9]+)$').match(group_id)
+    if group_id is not None:
+        matched_group = GROUP_ID_RE.match(group_id)
         if not matched_group:
             module.fail_json(msg="Invalid group id '%s' specified. The group id should be of the form 'gX' or 'X' where 'X' is the integer id on the Hue hub" % group_id)
         else:
-            group_id = matched_group.group(0)
-            group_state = hue_config.get('groups', {}).get(group_id)
+            group_id = matched_group.group(1)
+
+    # Create our custom Hue() object and fetch the targeted group. When an
+    # id is given, only that group is fetched. If there is no such group the
+    # bridge answers with a "resource not available" error, while any other
+    # error (such as not being registered) fails the module. Otherwise we
+    # search through all of the groups for one matching the given name.
+    try:
+        hue = Hue(bridge=module.params['bridge'])
+        if group_id is not None:
+            group_state = hue.get_group_state(group_id)
+            if isinstance(group_state, list) and group_state[0].get('error', {}).get('type') == RESOURCE_NOT_AVAILABLE:
+                group_state = None
+            else:
+                hue.check_error(group_state)
+        else:
+            groups = hue.check_error(hue.get_groups()) or {}
+            group_ids = dict((group_config.get('name'), _id) for _id, group_config in groups.items())
+            group_id = group_ids.get(group_name)
+            if group_id is not None:
+                group_state = groups[group_id]
+    except Exception as e:
+        module.fail_json(msg="Failed to connect to the Hue bridge. Make sure you've registered with it first using the hue_register module. Error was: %s" % str(e))
 
     state = module.params['state']
 
@@ -263,15 +343,24 @@ def main():
             res = hue.create_group(desired_state)
         else:
             message = "Group updated successfully."
-            res = hue.update_group(group_id, desired_state)
+            if changed:
+                res = hue.update_group(group_id, desired_state)
+            else:
+                res = [{'success': {}}]
 
         failed = not hue.check_success(res)
         if failed:
             module.fail_json(msg="Failed to create/update the group '%s'." % (group_id or group_name,), res=res)
         else:
+            # A new group only gets its id (and the rest of the fields the
+            # bridge fills in) on creation, so we have to fetch it. For an
+            # update, the final state is the current state with our changes.
             if group_id is None:
                 group_id = res[0].get('success').get("id")
-            group_config = hue.get_group_state(group_id)
+                group_config = hue.get_group_state(group_id)
+            else:
+                group_config = dict(group_state or {})
+                group_config.update(desired_state)
             module.exit_json(changed=changed, group=group_config)
 
 # import module snippets
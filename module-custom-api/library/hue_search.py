@@ -16,16 +16,42 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import hashlib
 import socket
 import time
 
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
 try:
     import json
     HAS_JSON = True
 except ImportError:
     HAS_JSON = False
 
+# orjson is a good deal faster than the stdlib json module at encoding
+# and decoding, so it is used for talking to the bridge when available
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# The token only depends on the host we're running on, so it's computed once
+# when the module is loaded. The token code here is copied from python-hue:
+# https://github.com/issackelly/python-hue/blob/master/hue/hue.py
+try:
+    _fqdn = socket.getfqdn()
+except socket.error:
+    _fqdn = socket.gethostname()
+HUE_TOKEN = hashlib.md5(("ph-%s" % _fqdn).encode('utf-8')).hexdigest()
+
+# time.monotonic() isn't available on python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
 DOCUMENTATION = '''
 ---
 module: hue_scan
@@ -57,40 +83,90 @@ EXAMPLES = '''
     - 000002
 '''
 
+def connection_dropped(e):
+    '''
+    Returns whether an error raised while sending a request means the bridge
+    closed the persistent connection on us, as opposed to the bridge being
+    unreachable or too slow to answer (in which case it may well have acted
+    on the request already).
+    '''
+    # RemoteDisconnected, raised on python 3, is a subclass of BadStatusLine
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
 class Hue(object):
+    __slots__ = ('bridge', 'token', '_base', '_conn')
+
     def __init__(self, bridge):
         self.bridge = bridge
-
-        # the token code here is copied from python-hue
-        # https://github.com/issackelly/python-hue/blob/master/hue/hue.py
-        self.token = hashlib.md5("ph-%s" % socket.getfqdn()).hexdigest()
+        self.token = HUE_TOKEN
+        self._base = '/api/%s' % self.token
+
+        # a single connection to the bridge is kept open and reused for
+        # every request made through this object
+        self._conn = httplib.HTTPConnection(self.bridge, timeout=5)
+
+    def _request(self, method, path, data=None):
+        '''
+        Sends a request to the bridge over the persistent connection and
+        returns the decoded JSON response. Some bridges ignore keep-alive
+        and close the socket between requests, so we reconnect and retry
+        once if the connection was dropped. Any other error (including a
+        timeout) is raised straight away. POSTs are never retried, since the
+        bridge may have acted on the first attempt, so instead they are
+        always sent over a fresh connection.
+        '''
+        if data is not None:
+            data = orjson.dumps(data) if HAS_ORJSON else json.dumps(data)
+        headers = {'Connection': 'keep-alive', 'Content-Type': 'application/json'}
+        if method == 'POST':
+            self._conn.close()
+        try:
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            if method == 'POST' or not connection_dropped(e):
+                raise
+            self._conn.close()
+            self._conn.request(method, path, data, headers)
+            res = self._conn.getresponse()
+        if HAS_ORJSON:
+            return orjson.loads(res.read())
+        return json.load(res)
 
     def check_success(self, result):
-        for status in result:
-            if 'failed' in status.keys():
-                return False
-        return True
+        return not any('failed' in status for status in result)
 
     def get_config(self):
-        url = 'http://%s/api/%s' % (self.bridge, self.token)
-        res = open_url(url, method='GET', timeout=5)
-        return json.load(res)
+        return self._request('GET', self._base)
+
+    def ping(self):
+        '''
+        Checks whether we're registered with the bridge. This only fetches
+        the (small) config section, which the bridge answers for anyone but
+        only includes the whitelist of registered users in when the token
+        is one of them.
+        '''
+        config = self._request('GET', '%s/config' % self._base)
+        return isinstance(config, dict) and 'whitelist' in config
 
     def search_for_lights(self, serial_numbers):
-        url = 'http://%s/api/%s/lights' % (self.bridge, self.token)
         data = dict(deviceid=serial_numbers)
-        res = open_url(url, data=json.dumps(data), method='POST')
-        return json.load(res)
+        return self._request('POST', '%s/lights' % self._base, data=data)
 
     def add_new_lights(self, timeout=120):
-        url = 'http://%s/api/%s/lights/new' % (self.bridge, self.token)
-        time_left = timeout
-        while time_left > 0:
-            res = open_url(url, method='GET', timeout=5)
-            data = json.load(res)
+        # Poll until the scan finishes, starting with a short delay so quick
+        # scans are picked up promptly and backing off (up to 5 seconds) so
+        # we don't keep hitting the bridge during a long one
+        url = '%s/lights/new' % self._base
+        delay = 0.5
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            data = self._request('GET', url)
             if 'lastscan' in data and data.get('lastscan') == 'active':
-                time.sleep(1)
-                time_left -= 1
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
                 continue
             else:
                 return data
@@ -113,9 +189,11 @@ def main():
     # create our custom Hue() object and validate we're talking to it
     try:
         hue = Hue(bridge=module.params['bridge'])
-        hue_config = hue.get_config()
-    except Exception, e:
+        registered = hue.ping()
+    except Exception as e:
         module.fail_json(msg="Failed to connect to the Hue bridge. Make sure you've registered with it first using the hue_register module. Error was: %s" % str(e))
+    if not registered:
+        module.fail_json(msg="Failed to connect to the Hue bridge. Make sure you've registered with it first using the hue_register module.")
 
     try:
         res = hue.search_for_lights(module.params['serial_numbers'])
@@ -128,7 +206,7 @@ def main():
 
         hue_config = hue.get_config()
         module.exit_json(changed=True, msg="Search completed successfully", config=hue_config)
-    except Exception, e:
+    except Exception as e:
         module.fail_json(msg="Failed to scan/add new lights. Error was: %s" % str(e))
 
 # import module snippets
@@ -1,4 +1,5 @@
 #!/usr/bin/python
+# -*- coding: utf-8 -*-
 
 # (c) 2016, James Cammarata <jimi@sngx.net>
 #
@@ -15,14 +16,53 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import socket
 import time
 
+try:
+    import json
+    HAS_JSON = True
+except ImportError:
+    HAS_JSON = False
+
+# orjson is a good deal faster than the stdlib json module at encoding
+# and decoding, so it is used for talking to the bridge when available
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 try:
     from hue import Hue
     HUE_AVAILABLE = True
 except ImportError:
     HUE_AVAILABLE = False
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    HAS_FUTURES = True
+except ImportError:
+    HAS_FUTURES = False
+
+# dict.items() builds a whole list of (key, value) pairs on python 2, so
+# we use iteritems() where it exists instead
+try:
+    iteritems = dict.iteritems
+except AttributeError:
+    iteritems = dict.items
+
+# The token python-hue registers with the bridge only depends on the host
+# we're running on, so it's computed once when the module is loaded. This
+# mirrors the token code in python-hue:
+# https://github.com/issackelly/python-hue/blob/master/hue/hue.py
+try:
+    _fqdn = socket.getfqdn()
+except socket.error:
+    _fqdn = socket.gethostname()
+HUE_TOKEN = hashlib.md5(("ph-%s" % _fqdn).encode('utf-8')).hexdigest()
+
 DOCUMENTATION = '''
 ---
 module: hue
@@ -101,7 +141,19 @@ EXAMPLES = '''
 
 '''
 
-STATE_FIELDS = ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect',)
+STATE_FIELDS = frozenset(('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect',))
+
+# The maximum number of lights we'll talk to at once. The bridge is a small
+# embedded device, so we don't want to flood it with requests.
+MAX_WORKERS = 8
+
+# The Wide Gamut RGB to XYZ conversion matrix, from the colorspace values here:
+# http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
+RGB2XYZ = (
+    (0.7161046, 0.1009296, 0.1471858),
+    (0.2581874, 0.7249378, 0.0168748),
+    (0.0000000, 0.0517813, 0.7734287),
+)
 
 def hex2rgb(hex):
     '''
@@ -109,20 +161,53 @@ def hex2rgb(hex):
     '''
     hex = hex.lstrip('#')
     assert len(hex) == 6
-    return (int(hex[0:2], 16), int(hex[2:4], 16), int(hex[4:6], 16))
+    return tuple(bytearray.fromhex(hex))
 
 def rgb2xy(r, g, b):
     '''
-    Converts an RGB value to xyz coordinates, based on matrix transformations
-    of colorspace values here (Wide Gamut RGB):
-    http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
+    Converts an RGB value to xy coordinates, using the RGB2XYZ matrix
+    and normalizing the result. Black has no chromaticity, so it maps
+    to [0.0, 0.0].
     '''
-    X = 0.7161046 * r + 0.1009296 * g + 0.1471858 * b
-    Y = 0.2581874 * r + 0.7249378 * g + 0.0168748 * b
-    Z = 0.0000000 * r + 0.0517813 * g + 0.7734287 * b
-    x = X / (X+Y+Z)
-    y = Y / (X+Y+Z)
-    return [x, y]
+    X, Y, Z = [m_r * r + m_g * g + m_b * b for (m_r, m_g, m_b) in RGB2XYZ]
+    total = X + Y + Z
+    if total == 0:
+        return [0.0, 0.0]
+    return [X / total, Y / total]
+
+def map_lights(func, light_names):
+    '''
+    Calls func for each of the given light names, spreading the calls over
+    a small pool of threads when there's more than one light. Returns a dict
+    of light name to the value func returned, or the exception it raised.
+    '''
+    def _call(light_name):
+        try:
+            return func(light_name)
+        except Exception as e:
+            return e
+
+    light_names = list(light_names)
+    if len(light_names) > 1 and HAS_FUTURES:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(light_names))) as executor:
+            results = list(executor.map(_call, light_names))
+    else:
+        results = [_call(light_name) for light_name in light_names]
+    return dict(zip(light_names, results))
+
+def set_all_lights(bridge, state):
+    '''
+    Sets the state of every light on the bridge with one request, using the
+    special group 0 which contains all of the lights. python-hue doesn't
+    expose groups, so the request is made directly, using the same client
+    identifier python-hue registers with.
+    '''
+    url = 'http://%s/api/%s/groups/0/action' % (bridge, HUE_TOKEN)
+    if HAS_ORJSON:
+        res = open_url(url, data=orjson.dumps(state), method='PUT', timeout=5)
+        return orjson.loads(res.read())
+    res = open_url(url, data=json.dumps(state), method='PUT', timeout=5)
+    return json.load(res)
 
 def build_state(module, cur_state):
     '''
@@ -130,14 +215,22 @@ def build_state(module, cur_state):
     of the given light object from the python-hue library.
     '''
     light_state = dict()
+    changed = False
+
+    # Sets a field in the new state, noting whether it differs from the
+    # current state. Only the fields in STATE_FIELDS count as changes, as
+    # we don't want to set any fields outside of those.
+    def set_field(field, value):
+        light_state[field] = value
+        return field in STATE_FIELDS and cur_state.get(field) != value
 
     # set the 'on' state
-    light_state['on'] = module.params.get('on')
+    changed |= set_field('on', module.params.get('on'))
 
     # set the brightness
     bri = module.params.get('brightness', None)
     if bri is not None:
-        light_state['bri'] = bri
+        changed |= set_field('bri', bri)
 
     # set the alert
     alert = module.params.get('alert', None)
@@ -145,7 +238,7 @@ def build_state(module, cur_state):
         alert = alert.lower()
         if alert not in ('none', 'select', 'lselect'):
             module.fail_json(msg="The alert setting must be one of the following values: none, select or lselect")
-        light_state['alert'] = alert
+        changed |= set_field('alert', alert)
 
     # set the effect
     effect = module.params.get('effect', None)
@@ -153,28 +246,28 @@ def build_state(module, cur_state):
         effect = effect.lower()
         if effect not in ('none', 'colorloop'):
             module.fail_json(msg="The effect setting must be one of the following values: none or colorloop")
-        light_state['effect'] = effect
+        changed |= set_field('effect', effect)
 
     # set the transition time
     transition_time = module.params.get('transition_time', None)
     if transition_time is not None:
-        light_state['transitiontime'] = transition_time
+        changed |= set_field('transitiontime', transition_time)
 
     # Figure out which color mode we're using...
-    if 'hue' in module.params or 'saturation' in module.params:
+    if module.params.get('hue') is not None or module.params.get('saturation') is not None:
         hue = module.params.get('hue', None)
         if hue is not None:
-            light_state['hue'] = hue
+            changed |= set_field('hue', hue)
         sat = module.params.get('saturation', None)
         if sat is not None:
-            light_state['sat'] = sat
-    elif 'xy' in module.params or 'rgb' in module.params:
-        if 'rgb' in module.params:
+            changed |= set_field('sat', sat)
+    elif module.params.get('xy') is not None or module.params.get('rgb') is not None:
+        if module.params.get('rgb') is not None:
             # The Hue doesn't support RGB by default, and python-hue does
             # the conversion internally. So to make sure we can preserve
             # idempotency we do the conversion calculation ourselves
             try:
-                x, y = rgb2xyz(hex2rgb(module.params['rgb']))
+                x, y = rgb2xy(*hex2rgb(module.params['rgb']))
             except:
                 module.fail_json(msg="Invalid RGB hex string: %s" % module.params['rgb'])
         else:
@@ -185,21 +278,12 @@ def build_state(module, cur_state):
             except:
                 module.fail_json(msg="Invalid xy value. Expected an array of 2 floating point values (0.0 >= [x,y] >= 1.0) but got %s" % (module.params['xy'],))
 
-        light_state['xy'] = [x, y]
-    elif 'color_temp' in module.params:
+        changed |= set_field('xy', [x, y])
+    elif module.params.get('color_temp') is not None:
         ct = module.params['color_temp']
         if ct < 153 or ct > 500:
-            module.warning('The color temperature specified (%d) may be outside of the recommend range (153-500) listed in the Hue API documentation' % ct)
-        light_state['ct'] = ct
-
-    # Test to see if any fields changed. We only test those set in
-    # the global constant as we don't want to set any fields outside
-    # of those        
-    changed = False
-    for field in STATE_FIELDS:
-        if field in light_state and cur_state.get(field) != light_state.get(field):
-            changed = True
-            break
+            module.warn('The color temperature specified (%d) may be outside of the recommend range (153-500) listed in the Hue API documentation' % ct)
+        changed |= set_field('ct', ct)
 
     return (changed, light_state)
 
@@ -232,7 +316,7 @@ def main():
         h = Hue()
         h.station_ip = module.params['bridge']
         h.get_state()
-    except Exception, e:
+    except Exception as e:
         module.fail_json(msg="Failed to connect to the Hue hub. Make sure you've registered using the hue_register module first. Error was: %s" % str(e))
 
     # set initial flags
@@ -260,30 +344,67 @@ def main():
             module.fail_json(msg="Failed to find light '%s'. Make sure that the light was turned on." % name)
 
     # Then, for each light in the list, fetch the current state and build
-    # the desired state (assuming the light is reachable)
-    for light_name in lights_to_check:
-        the_light = h.lights.get(light_name)
+    # the desired state (assuming the light is reachable). Each of these is
+    # a separate request to the hub, so they're made in parallel.
+    def fetch_state(light_name):
+        the_light = h.lights[light_name]
         the_light.update_state_cache()
-        if not the_light.state.get('state', {}).get('reachable', True):
-            final_states[light_name] = the_light.state.copy()
+        return the_light.state.copy()
+
+    for light_name, light_state in iteritems(map_lights(fetch_state, lights_to_check)):
+        if isinstance(light_state, Exception):
+            final_states[light_name] = dict(failed=True, msg=str(light_state))
+            failed = True
+        elif not light_state.get('state', {}).get('reachable', True):
+            final_states[light_name] = light_state
             failed = True
         else:
-            state_changed, desired_state = build_state(module, the_light.state)
+            state_changed, desired_state = build_state(module, light_state.get('state', {}))
             changed |= state_changed
-            target_lights[light_name] = desired_state
-
-    # Next, we set the state of each light as requested above
-    for target_light, target_state in iter(target_lights.items()):
-        the_light = h.lights[target_light]
-        if not module.check_mode and len(target_state) > 0:
+            target_lights[light_name] = (desired_state, state_changed)
+
+    # Next, we set the state of each light as requested above, again in
+    # parallel. Lights which are already in the desired state are skipped.
+    def update_state(light_name):
+        the_light = h.lights[light_name]
+        target_state, state_changed = target_lights[light_name]
+        if state_changed and not module.check_mode and len(target_state) > 0:
             # get the light and set the state
             the_light = the_light.set_state(target_state)
             the_light.update_state_cache()
-            if not the_light.state.get('state', {}).get('reachable', True):
-                failed = True
+        return the_light.state.copy()
+
+    # When every light is reachable and getting the same state, a single
+    # request to group 0 replaces one request per light. If that fails for
+    # any reason, we fall back to setting each light individually.
+    target_states = list(target_lights.values())
+    set_as_group = (
+        name == 'all' and not module.check_mode and HAS_JSON and
+        1 < len(target_lights) == len(lights_to_check) and
+        all(target_state == target_states[0] for target_state in target_states) and
+        target_states[0][1]
+    )
+    if set_as_group:
+        try:
+            result = set_all_lights(module.params['bridge'], target_states[0][0])
+            set_as_group = not any('error' in status for status in result)
+        except Exception:
+            set_as_group = False
 
+    if set_as_group:
+        light_states = map_lights(fetch_state, target_lights)
+    else:
+        light_states = map_lights(update_state, target_lights)
+
+    for target_light, light_state in iteritems(light_states):
         # save the state for the final module result
-        final_states[target_light] = the_light.state.copy()
+        if isinstance(light_state, Exception):
+            final_states[target_light] = dict(failed=True, msg=str(light_state))
+            failed = True
+        else:
+            final_states[target_light] = light_state
+            if not module.check_mode and not light_state.get('state', {}).get('reachable', True):
+                failed = True
 
     # If one or more lights failed, fail the module, otherwise return
     # whether or not we changed. In both cases, we return the state of
@@ -298,5 +419,6 @@ def main():
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.urls import *
 main()
 
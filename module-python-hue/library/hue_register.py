@@ -64,7 +64,7 @@ def main():
         h = Hue()
         h.station_ip = module.params['bridge']
         h.authenticate()
-    except Exception, e:
+    except Exception as e:
         module.fail_json(msg="Failed to authenticate to the Hue hub. Make sure you've pushed the button on the hub recently. Error was: %s" % str(e))
 
     module.exit_json(changed=True, msg="Successfully authenticated with the Hue hub")